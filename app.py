@@ -1,28 +1,133 @@
-from fastapi import FastAPI, BackgroundTasks
-from tagging import auto_tag_recipes, tag_recipe_by_id, bulk_insert_keywords, bulk_insert_tags
+from fastapi import FastAPI, BackgroundTasks, HTTPException
+from pydantic import BaseModel, conlist, constr
+from tagging import (
+    auto_tag_recipes,
+    tag_recipe_by_id_async,
+    tag_recipes_by_ids_async,
+    bulk_insert_keywords,
+    bulk_insert_tags,
+    reconcile_recipe_tags,
+    get_pool_stats,
+    TAGGING_MODES,
+    AUTO_TAG_WORKERS,
+    MAX_AUTO_TAG_WORKERS,
+    auto_tag_running,
+    classify_text,
+    get_dictionary_matcher,
+)
+from jobs import create_job, create_exclusive_job, find_active_job, get_job, run_job
 
 app = FastAPI()
 
+
+class TagRecipesRequest(BaseModel):
+    recipe_ids: conlist(int, min_items=1, max_items=5000)
+
+
+class ClassifyRequest(BaseModel):
+    text: constr(max_length=2000)
+
+
+# compile the keywords.py matcher up front so /classify never pays for it
+@app.on_event("startup")
+def warm_dictionary_matcher():
+    get_dictionary_matcher()
+
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Recipe Tagging API"}
 
+@app.get("/pool-stats")
+def pool_stats():
+    return get_pool_stats()
+
 @app.get("/upsert-tags")
 def upsert_tags(background_tasks: BackgroundTasks):
-    background_tasks.add_task(bulk_insert_tags)
-    return {"status": "Tag insertion started in the background"}
+    job = create_job("upsert-tags")
+    background_tasks.add_task(run_job, job, bulk_insert_tags)
+    return {"status": "Tag insertion started in the background", "job_id": job.id}
 
 @app.get("/upsert-keywords")
-def upsert_keywords(background_tasks: BackgroundTasks):
-    background_tasks.add_task(bulk_insert_keywords)
-    return {"status": "Keyword insertion started in the background"}
+def upsert_keywords(background_tasks: BackgroundTasks, retag: bool = False):
+    job = create_job("upsert-keywords", {"retag": retag})
+    background_tasks.add_task(run_job, job, bulk_insert_keywords, retag)
+    return {"status": "Keyword insertion started in the background", "job_id": job.id}
+
+@app.get("/reconcile-tags")
+def reconcile_tags(background_tasks: BackgroundTasks):
+    job = create_job("reconcile-tags")
+    background_tasks.add_task(run_job, job, reconcile_recipe_tags)
+    return {"status": "Tag reconciliation started in the background", "job_id": job.id}
 
 @app.get("/tag-all-recipes")
-def tag_recipes(background_tasks: BackgroundTasks):
-    background_tasks.add_task(auto_tag_recipes)
-    return {"status": "Tagging started in the background"}
+def tag_recipes(
+    background_tasks: BackgroundTasks,
+    mode: str = "regex",
+    incremental: bool = False,
+    workers: int = AUTO_TAG_WORKERS,
+    include_instructions: bool = False,
+):
+    if mode not in TAGGING_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown tagging mode '{mode}'")
+    if not 1 <= workers <= MAX_AUTO_TAG_WORKERS:
+        raise HTTPException(
+            status_code=400, detail=f"workers must be between 1 and {MAX_AUTO_TAG_WORKERS}"
+        )
+    if workers > 1 and mode != "automaton":
+        raise HTTPException(status_code=400, detail="Parallel workers require automaton mode")
+    if include_instructions and mode != "automaton":
+        raise HTTPException(status_code=400, detail="Instruction scanning requires automaton mode")
+    # one run at a time: hand back the running job instead of starting another
+    if auto_tag_running():
+        existing = find_active_job("tag-all-recipes")
+        if existing is None:
+            raise HTTPException(status_code=409, detail="Tagging is already running elsewhere")
+        return {"status": "Tagging already in progress", "job_id": existing.id}
+    job, created = create_exclusive_job(
+        "tag-all-recipes",
+        {
+            "mode": mode,
+            "incremental": incremental,
+            "workers": workers,
+            "include_instructions": include_instructions,
+        },
+    )
+    if not created:
+        return {"status": "Tagging already in progress", "job_id": job.id}
+    background_tasks.add_task(
+        run_job,
+        job,
+        auto_tag_recipes,
+        mode,
+        incremental,
+        workers=workers,
+        include_instructions=include_instructions,
+        job=job,
+    )
+    return {"status": f"Tagging started in the background ({mode} mode)", "job_id": job.id}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
 
 @app.get("/tag-recipe/{recipe_id}")
-def tag_recipe(recipe_id: int, background_tasks: BackgroundTasks):
-    background_tasks.add_task(tag_recipe_by_id, recipe_id)
-    return {"status": f"Tagging started for recipe {recipe_id} in the background"}
\ No newline at end of file
+async def tag_recipe(recipe_id: int):
+    result = await tag_recipe_by_id_async(recipe_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Recipe {recipe_id} not found")
+    return {"status": f"Recipe {recipe_id} tagged", **result}
+
+@app.post("/tag-recipes")
+async def tag_recipes_batch(request: TagRecipesRequest):
+    results = await tag_recipes_by_ids_async(request.recipe_ids)
+    return {"status": f"Tagged {sum(r['found'] for r in results)} recipes", "results": results}
+
+# preview tags for raw text (e.g. a title being typed) without touching the
+# database; async so the in-memory match skips the threadpool hop
+@app.post("/classify")
+async def classify(request: ClassifyRequest):
+    return {"tags": classify_text(request.text)}
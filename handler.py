@@ -1,3 +1,8 @@
+import os
+
+# one warm connection per Lambda container instead of a new one per request
+os.environ.setdefault("DB_POOL_MODE", "single")
+
 from app import app
 from mangum import Mangum
 
@@ -0,0 +1,335 @@
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import text
+
+from tagging import engine, DB_NAME, SCHEMA_LOCK_KEY
+
+
+# Background jobs started by the API get an id and a progress record that
+# GET /jobs/{id} reports. Records live in this process; with JOBS_PERSIST set
+# they are also written to tagger_jobs (on state changes and at most every
+# JOB_PERSIST_INTERVAL seconds of progress), so other workers and restarted
+# processes can still answer for them. A running job is also re-saved every
+# JOB_PERSIST_INTERVAL as a heartbeat, even inside one long chunk; a pending or
+# running row not updated for JOB_STALE_AFTER seconds belonged to a process
+# that died, and is marked failed instead of blocking new runs.
+JOBS_PERSIST = os.getenv("JOBS_PERSIST", "false").lower() in ("1", "true", "yes")
+JOB_PERSIST_INTERVAL = float(os.getenv("JOB_PERSIST_INTERVAL", "5"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", str(JOB_PERSIST_INTERVAL * 3)))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "100"))
+
+JOB_STATES = ("pending", "running", "succeeded", "failed")
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_jobs_table_ready = False
+
+
+class Job:
+    def __init__(self, kind, params=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.state = "pending"
+        self.total = None
+        self.processed = 0
+        self.mappings = 0
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._saved_at = 0
+
+    def start(self):
+        with _jobs_lock:
+            self.state = "running"
+            self.started_at = time.time()
+        save_job(self, force=True)
+
+    # total is the number of recipes the job expects to process, if known
+    def set_total(self, total):
+        with _jobs_lock:
+            self.total = total
+        save_job(self, force=True)
+
+    def advance(self, recipes=0, mappings=0):
+        with _jobs_lock:
+            self.processed += recipes
+            self.mappings += mappings
+        save_job(self)
+
+    def finish(self):
+        with _jobs_lock:
+            self.state = "succeeded"
+            self.finished_at = time.time()
+        save_job(self, force=True)
+
+    def fail(self, error):
+        with _jobs_lock:
+            self.state = "failed"
+            self.error = str(error)
+            self.finished_at = time.time()
+        save_job(self, force=True)
+
+    def to_dict(self):
+        with _jobs_lock:
+            elapsed = None
+            if self.started_at is not None:
+                elapsed = (self.finished_at or time.time()) - self.started_at
+
+            recipes_per_sec = mappings_per_sec = eta = None
+            if elapsed:
+                recipes_per_sec = self.processed / elapsed
+                mappings_per_sec = self.mappings / elapsed
+            if self.state == "running" and self.total is not None and recipes_per_sec:
+                eta = max(self.total - self.processed, 0) / recipes_per_sec
+
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "params": self.params,
+                "state": self.state,
+                "total_recipes": self.total,
+                "recipes_processed": self.processed,
+                "mappings_written": self.mappings,
+                "recipes_per_sec": recipes_per_sec,
+                "mappings_per_sec": mappings_per_sec,
+                "elapsed_seconds": elapsed,
+                "eta_seconds": eta,
+                "error": self.error,
+            }
+
+
+# register a new job, forgetting the oldest finished ones beyond JOB_HISTORY;
+# the caller holds _jobs_lock
+def _register(job):
+    finished = sorted(
+        (j for j in _jobs.values() if j.finished_at is not None),
+        key=lambda j: j.finished_at,
+    )
+    for old in finished[: max(len(_jobs) + 1 - JOB_HISTORY, 0)]:
+        del _jobs[old.id]
+    _jobs[job.id] = job
+
+
+def _is_active(job, kind):
+    return job.kind == kind and job.state in ("pending", "running")
+
+
+def create_job(kind, params=None):
+    job = Job(kind, params)
+    with _jobs_lock:
+        _register(job)
+    save_job(job, force=True)
+    return job
+
+
+# most recent pending or running job of this kind, here or (with
+# JOBS_PERSIST) in another process
+def find_active_job(kind):
+    with _jobs_lock:
+        active = [job for job in _jobs.values() if _is_active(job, kind)]
+    if active:
+        return max(active, key=lambda job: job.created_at)
+    if JOBS_PERSIST:
+        ensure_jobs_table()
+        with engine.begin() as conn:
+            conn.execute(
+                text(f"""
+                    UPDATE {DB_NAME}.tagger_jobs
+                    SET state = 'failed',
+                        error = :error,
+                        finished_at = now(),
+                        updated_at = now()
+                    WHERE kind = :kind AND state IN ('pending', 'running')
+                      AND updated_at < now() - make_interval(secs => :stale_after)
+                """),
+                {
+                    "kind": kind,
+                    "stale_after": JOB_STALE_AFTER,
+                    "error": f"abandoned: no heartbeat for {JOB_STALE_AFTER:g} seconds",
+                },
+            )
+            job_id = conn.execute(
+                text(f"""
+                    SELECT job_id FROM {DB_NAME}.tagger_jobs
+                    WHERE kind = :kind AND state IN ('pending', 'running')
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                """),
+                {"kind": kind},
+            ).scalar()
+        if job_id is not None:
+            return load_job(job_id)
+    return None
+
+
+# like create_job, but returns (existing, False) instead when a job of this
+# kind is already pending or running in this process
+def create_exclusive_job(kind, params=None):
+    with _jobs_lock:
+        for job in _jobs.values():
+            if _is_active(job, kind):
+                return job, False
+        job = Job(kind, params)
+        _register(job)
+    save_job(job, force=True)
+    return job, True
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None and JOBS_PERSIST:
+        job = load_job(job_id)
+    return job
+
+
+def _heartbeat(job, stop):
+    while not stop.wait(JOB_PERSIST_INTERVAL):
+        save_job(job, force=True)
+
+
+# run func(*args, **kwargs) as the body of job, recording how it ended; pass
+# job=job in kwargs to functions that report their own progress. The heartbeat
+# is joined before the final state is saved so it cannot overwrite it.
+def run_job(job, func, *args, **kwargs):
+    job.start()
+    stop = threading.Event()
+    heartbeat = None
+    if JOBS_PERSIST:
+        heartbeat = threading.Thread(target=_heartbeat, args=(job, stop), daemon=True)
+        heartbeat.start()
+    try:
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            stop.set()
+            if heartbeat is not None:
+                heartbeat.join()
+    except Exception as e:
+        job.fail(e)
+        print(f"Job {job.id} ({job.kind}) failed: {e}")
+        raise
+    job.finish()
+    print(f"Job {job.id} ({job.kind}) finished.")
+    return result
+
+
+# created on first use in its own transaction, behind the same advisory lock
+# as tagging.setup_database(), and only remembered once that has committed
+def ensure_jobs_table():
+    global _jobs_table_ready
+    if _jobs_table_ready:
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT to_regclass(:name) IS NOT NULL"),
+            {"name": f"{DB_NAME}.tagger_jobs"},
+        ).scalar()
+        if not exists:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            conn.execute(
+                text(f"""
+                    CREATE TABLE IF NOT EXISTS {DB_NAME}.tagger_jobs (
+                        job_id text PRIMARY KEY,
+                        kind text NOT NULL,
+                        state text NOT NULL,
+                        total bigint,
+                        processed bigint NOT NULL DEFAULT 0,
+                        mappings bigint NOT NULL DEFAULT 0,
+                        error text,
+                        created_at timestamptz NOT NULL,
+                        started_at timestamptz,
+                        finished_at timestamptz,
+                        updated_at timestamptz NOT NULL DEFAULT now()
+                    );
+                """)
+            )
+    _jobs_table_ready = True
+
+
+# progress updates are throttled; state changes pass force=True. A failed
+# write is only logged, it never fails the job itself.
+def save_job(job, force=False):
+    if not JOBS_PERSIST:
+        return
+    now = time.time()
+    if not force and now - job._saved_at < JOB_PERSIST_INTERVAL:
+        return
+    job._saved_at = now
+
+    with _jobs_lock:
+        row = {
+            "job_id": job.id,
+            "kind": job.kind,
+            "state": job.state,
+            "total": job.total,
+            "processed": job.processed,
+            "mappings": job.mappings,
+            "error": job.error,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+        }
+    try:
+        ensure_jobs_table()
+        with engine.begin() as conn:
+            conn.execute(
+                text(f"""
+                    INSERT INTO {DB_NAME}.tagger_jobs (
+                        job_id, kind, state, total, processed, mappings, error,
+                        created_at, started_at, finished_at
+                    )
+                    VALUES (
+                        :job_id, :kind, :state, :total, :processed, :mappings, :error,
+                        to_timestamp(:created_at), to_timestamp(:started_at),
+                        to_timestamp(:finished_at)
+                    )
+                    ON CONFLICT (job_id) DO UPDATE
+                    SET state = EXCLUDED.state,
+                        total = EXCLUDED.total,
+                        processed = EXCLUDED.processed,
+                        mappings = EXCLUDED.mappings,
+                        error = EXCLUDED.error,
+                        started_at = EXCLUDED.started_at,
+                        finished_at = EXCLUDED.finished_at,
+                        updated_at = now();
+                """),
+                row,
+            )
+    except Exception as e:
+        print(f"Could not persist job {job.id}: {e}")
+
+
+def load_job(job_id):
+    ensure_jobs_table()
+    with engine.begin() as conn:
+        row = conn.execute(
+            text(f"""
+                SELECT
+                    kind, state, total, processed, mappings, error,
+                    extract(epoch FROM created_at) AS created_at,
+                    extract(epoch FROM started_at) AS started_at,
+                    extract(epoch FROM finished_at) AS finished_at
+                FROM {DB_NAME}.tagger_jobs
+                WHERE job_id = :job_id
+            """),
+            {"job_id": job_id},
+        ).mappings().fetchone()
+    if row is None:
+        return None
+
+    job = Job(row["kind"], job_id=job_id)
+    job.state = row["state"]
+    job.total = row["total"]
+    job.processed = row["processed"]
+    job.mappings = row["mappings"]
+    job.error = row["error"]
+    job.created_at = float(row["created_at"])
+    job.started_at = float(row["started_at"]) if row["started_at"] is not None else None
+    job.finished_at = float(row["finished_at"]) if row["finished_at"] is not None else None
+    return job
@@ -1,13 +1,26 @@
-from tagging import auto_tag_recipes,bulk_insert_keywords, bulk_insert_tags
+from tagging import auto_tag_recipes,bulk_insert_keywords, bulk_insert_tags, reconcile_recipe_tags, setup_database, TaggingRunInProgress
+import sys
 import time
 
 
 if __name__ == "__main__":
     start_time = time.time()
 
-    bulk_insert_tags()
-    bulk_insert_keywords()
-    auto_tag_recipes()
+    # create or upgrade the tagging schema before anything uses it; the API
+    # relies on this having run once per deployment
+    setup_database()
+    tag_lookup = bulk_insert_tags()
+    # pass --reconcile to also delete mappings no remaining keyword justifies
+    if "--reconcile" in sys.argv:
+        reconcile_recipe_tags(tag_lookup=tag_lookup)
+    else:
+        bulk_insert_keywords(tag_lookup=tag_lookup)
+    # pass --incremental to only tag recipes added since the last run
+    try:
+        auto_tag_recipes(incremental="--incremental" in sys.argv)
+    except TaggingRunInProgress as e:
+        print(e)
+        sys.exit(1)
     
     end_time = time.time()
     print(f"Total time taken: {end_time - start_time} seconds")
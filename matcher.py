@@ -0,0 +1,220 @@
+import re
+import unicodedata
+from collections import deque
+
+
+# Postgres treats letters, digits and underscore as word characters for \m / \M
+def is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+_NON_WORD = re.compile(r"\W+")
+
+# letters unaccent() transliterates that have no Unicode decomposition, so
+# NFKD plus dropping combining marks alone would leave them untouched
+_TRANSLITERATIONS = str.maketrans({
+    "Æ": "AE", "æ": "ae",
+    "Ð": "D", "ð": "d",
+    "Đ": "D", "đ": "d",
+    "Ħ": "H", "ħ": "h",
+    "ı": "i",
+    "Ĳ": "IJ", "ĳ": "ij",
+    "ĸ": "q",
+    "Ŀ": "L", "ŀ": "l",
+    "Ł": "L", "ł": "l",
+    "Ŋ": "N", "ŋ": "n",
+    "Œ": "OE", "œ": "oe",
+    "Ø": "O", "ø": "o",
+    "ß": "ss", "ẞ": "SS",
+    "ſ": "s",
+    "Þ": "TH", "þ": "th",
+    "Ŧ": "T", "ŧ": "t",
+    "ƀ": "b", "Ɓ": "B",
+    "ƒ": "f",
+    "©": "(C)", "®": "(R)",
+})
+
+
+# Python twin of the tagger_normalize() SQL function that maintains
+# recipe.recipe_name_norm: strip accents (transliterating like unaccent()),
+# case-fold, and collapse every run of non-word characters into a single space.
+def normalize_text(value):
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(ch for ch in value if not unicodedata.combining(ch))
+    value = value.translate(_TRANSLITERATIONS)
+    return _NON_WORD.sub(" ", value.lower()).strip()
+
+
+# Multi-keyword matcher (Aho-Corasick) with the same word-boundary rules as
+# recipe_name_norm ~ ('\m' || tagger_normalize(keyword) || '\M'), so a recipe
+# name is scanned once no matter how many keywords are loaded. Keywords are
+# normalized on add; text passed to iter_matches/match must already be
+# normalized (recipe_name_norm, or normalize_text() for raw input).
+class KeywordMatcher:
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._terminal = [[]]
+        self._out = [[]]
+        self._compiled = True
+        self.keywords = []
+        self.keyword_tags = []
+        self.tag_types = {}
+        self._keyword_index = {}
+
+    # pass normalized=True when the rows already hold normalized keywords,
+    # e.g. tagger_normalize(keyword) from the database
+    @classmethod
+    def from_rows(cls, rows, normalized=False):
+        matcher = cls()
+        for row in rows:
+            matcher.add(
+                row["keyword"],
+                row["tag_id"],
+                row.get("tag_type"),
+                row.get("keyword_id"),
+                normalized=normalized,
+            )
+        matcher.compile()
+        return matcher
+
+    def __len__(self):
+        return len(self.keywords)
+
+    # keyword_id records which tag_keywords row produced a match; when several
+    # rows normalize to the same keyword for a tag, the first one added wins
+    def add(self, keyword, tag_id, tag_type=None, keyword_id=None, normalized=False):
+        if tag_type is not None:
+            self.tag_types[tag_id] = tag_type
+        if not normalized:
+            keyword = normalize_text(keyword)
+        if not keyword:
+            return
+
+        index = self._keyword_index.get(keyword)
+        if index is None:
+            index = len(self.keywords)
+            self._keyword_index[keyword] = index
+            self.keywords.append(keyword)
+            self.keyword_tags.append({})
+
+            node = 0
+            for ch in keyword:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][ch] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._terminal.append([])
+                node = next_node
+            self._terminal[node].append(index)
+            self._compiled = False
+
+        self.keyword_tags[index].setdefault(tag_id, keyword_id)
+
+    def compile(self):
+        if self._compiled:
+            return
+        self._out = [list(indexes) for indexes in self._terminal]
+        queue = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            queue.append(child)
+
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[child] = target
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+        self._compiled = True
+
+    # yields (start, end, keyword_index) for every word-bounded keyword hit
+    def iter_matches(self, text):
+        self.compile()
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        keywords = self.keywords
+        length = len(text)
+
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if not out[node]:
+                continue
+
+            end = pos + 1
+            if not is_word_char(ch) or (end < length and is_word_char(text[end])):
+                continue
+            for index in out[node]:
+                start = end - len(keywords[index])
+                if not is_word_char(text[start]):
+                    continue
+                if start > 0 and is_word_char(text[start - 1]):
+                    continue
+                yield start, end, index
+
+    def match(self, text):
+        return set(self.match_details(text))
+
+    # tag_id -> (keyword_id, start offset) of the first match for each tag
+    def match_details(self, text):
+        details = {}
+        for start, _, index in self.iter_matches(text):
+            for tag_id, keyword_id in self.keyword_tags[index].items():
+                if tag_id not in details:
+                    details[tag_id] = (keyword_id, start)
+        return details
+
+    # Scan several text fields (e.g. name, then instructions) with bounded cost:
+    # each field is capped at max_chars and normalized, and a tag type counts
+    # as resolved once any of its tags matched. The first field is always
+    # scanned in full, so it yields the same tags as match(); later fields only
+    # add tags for unresolved types, and stop as soon as every type is resolved.
+    # Returns tag_id -> (keyword_id, offset) like match_details; the offset is
+    # only kept for matches in the first field and is None for later ones.
+    def match_fields(self, fields, max_chars=None):
+        all_types = set(self.tag_types.values())
+        details = {}
+        resolved = set()
+
+        for position, text in enumerate(fields):
+            if resolved and resolved >= all_types:
+                break
+            if not text:
+                continue
+            text = normalize_text(truncate_at_word(text, max_chars))
+
+            field_types = set()
+            for start, _, index in self.iter_matches(text):
+                for tag_id, keyword_id in self.keyword_tags[index].items():
+                    tag_type = self.tag_types.get(tag_id)
+                    if tag_type in resolved or tag_id in details:
+                        continue
+                    details[tag_id] = (keyword_id, start if position == 0 else None)
+                    field_types.add(tag_type)
+                if position > 0 and all_types and resolved | field_types >= all_types:
+                    break
+            resolved |= field_types
+
+        return details
+
+
+# cut text to at most max_chars without leaving a partial word at the end,
+# which could otherwise pass the word-boundary check ("hamburger" -> "ham")
+def truncate_at_word(text, max_chars):
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    end = max_chars
+    while end > 0 and is_word_char(text[end]) and is_word_char(text[end - 1]):
+        end -= 1
+    return text[:end]
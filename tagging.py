@@ -1,9 +1,15 @@
+import io
 import os
 import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, make_url, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool, QueuePool
 from collections import defaultdict
+from matcher import KeywordMatcher, normalize_text
 from keywords import (
     holiday_keywords,
     diet_keywords,
@@ -15,15 +21,161 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("POSTGRES_URL")
 DB_NAME = os.getenv("DB_NAME")
-engine = create_engine(DATABASE_URL, poolclass=NullPool)
+
+# Connection pooling is picked per deployment with DB_POOL_MODE:
+#   null   - new connection per checkout (default; batch runs via main.py)
+#   queue  - QueuePool sized by DB_POOL_SIZE / DB_MAX_OVERFLOW (uvicorn service)
+#   single - one pre-pinged connection reused across invocations (Lambda)
+DB_POOL_MODES = ("null", "queue", "single")
+DB_POOL_MODE = os.getenv("DB_POOL_MODE", "null")
+
+
+def _engine_options(pool_mode):
+    if pool_mode == "queue":
+        return {
+            "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            "pool_pre_ping": True,
+            "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        }
+    if pool_mode == "single":
+        return {"pool_size": 1, "max_overflow": 0, "pool_pre_ping": True}
+    if pool_mode == "null":
+        return {"poolclass": NullPool}
+    raise ValueError(f"Unknown DB_POOL_MODE '{pool_mode}', expected one of {DB_POOL_MODES}")
+
+
+# the sync engine always uses psycopg2, whatever driver the URL names (or
+# SQLAlchemy defaults to): copy_recipe_tags relies on its copy_expert
+def sync_database_url():
+    return make_url(DATABASE_URL).set(drivername="postgresql+psycopg2")
+
+
+def create_db_engine(pool_mode=DB_POOL_MODE):
+    return create_engine(sync_database_url(), **_engine_options(pool_mode))
+
+
+engine = create_db_engine()
 print("Database URL:", DATABASE_URL)
+print("Connection pool mode:", DB_POOL_MODE)
 
 
-def fetch_all_recipes(conn):
-    result = conn.execute(
-        text(f"SELECT recipe_id, recipe_name, instructions FROM {DB_NAME}.recipe")
-    ).mappings()
-    return result.fetchall()
+# Async engine (asyncpg) for the per-recipe endpoint, created on first use
+# with the same pooling mode as the sync engine. ASYNC_POSTGRES_URL is used
+# as-is when set; otherwise POSTGRES_URL is adapted, since the asyncpg dialect
+# hands URL query parameters straight to asyncpg.connect(), which rejects
+# libpq-only ones like ?sslmode=require.
+ASYNC_DATABASE_URL = os.getenv("ASYNC_POSTGRES_URL")
+_LIBPQ_ONLY_PARAMS = (
+    "sslrootcert",
+    "sslcert",
+    "sslkey",
+    "sslcrl",
+    "channel_binding",
+    "gssencmode",
+    "target_session_attrs",
+    "application_name",
+    "options",
+    "keepalives",
+    "keepalives_idle",
+    "keepalives_interval",
+    "keepalives_count",
+)
+_async_engine = None
+
+
+# (url, connect_args) for asyncpg: sslmode becomes asyncpg's ssl argument
+# (it takes the same mode names), connect_timeout its timeout, and the other
+# libpq-only parameters are dropped
+def _async_url_and_connect_args():
+    if ASYNC_DATABASE_URL:
+        return make_url(ASYNC_DATABASE_URL), {}
+    url = make_url(DATABASE_URL)
+    query = dict(url.query)
+    connect_args = {}
+    sslmode = query.pop("sslmode", None)
+    if sslmode is not None:
+        connect_args["ssl"] = sslmode
+    connect_timeout = query.pop("connect_timeout", None)
+    if connect_timeout is not None:
+        connect_args["timeout"] = float(connect_timeout)
+    for name in _LIBPQ_ONLY_PARAMS:
+        query.pop(name, None)
+    return url.set(drivername="postgresql+asyncpg", query=query), connect_args
+
+
+def get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        url, connect_args = _async_url_and_connect_args()
+        _async_engine = create_async_engine(
+            url, connect_args=connect_args, **_engine_options(DB_POOL_MODE)
+        )
+    return _async_engine
+
+
+def _describe_pool(pool):
+    stats = {"status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    return stats
+
+
+def get_pool_stats():
+    stats = {"mode": DB_POOL_MODE, **_describe_pool(engine.pool)}
+    if _async_engine is not None:
+        stats["async"] = _describe_pool(_async_engine.pool)
+    return stats
+
+
+RECIPE_BATCH_SIZE = int(os.getenv("RECIPE_BATCH_SIZE", "2000"))
+RECIPE_COLUMNS = ("recipe_name", "recipe_name_norm", "instructions")
+
+
+# Stream recipes through a server-side cursor in batches of (recipe_id, *columns)
+# tuples, so memory stays flat however large the catalog is. Defaults to the
+# name only; pass e.g. ("recipe_name_norm", "instructions") to pick others.
+def iter_recipes(
+    conn,
+    columns=("recipe_name",),
+    batch_size=RECIPE_BATCH_SIZE,
+    after_id=None,
+    upto_id=None,
+):
+    unknown = set(columns) - set(RECIPE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown recipe columns {sorted(unknown)}")
+
+    filters = []
+    params = {}
+    if after_id is not None:
+        filters.append("recipe_id > :after_id")
+        params["after_id"] = after_id
+    if upto_id is not None:
+        filters.append("recipe_id <= :upto_id")
+        params["upto_id"] = upto_id
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+
+    result = conn.execution_options(
+        stream_results=True, max_row_buffer=batch_size
+    ).execute(
+        text(f"""
+            SELECT recipe_id, {', '.join(columns)} FROM {DB_NAME}.recipe
+            {where}
+            ORDER BY recipe_id
+        """),
+        params,
+    )
+    try:
+        for batch in result.partitions(batch_size):
+            yield [tuple(row) for row in batch]
+    finally:
+        result.close()
 
 def get_all_tag_ids(conn):
     tag_ids = conn.execute(
@@ -34,21 +186,6 @@ def get_all_tag_ids(conn):
         tag_lookup[row["tag_type"]][row["tag_name"]] = row["tag_id"]
     return tag_lookup
 
-def fetch_all_tag_keywords(conn):
-    result = conn.execute(
-        text(f"SELECT tag_id, keyword FROM {DB_NAME}.tag_keywords")
-    ).mappings()
-
-    tag_map = {}
-    for row in result:
-        tag_id = row["tag_id"]
-        keyword = row["keyword"].lower()
-        if tag_id not in tag_map:
-            tag_map[tag_id] = set()
-        tag_map[tag_id].add(keyword)
-
-    return tag_map
-
 # Tag - tag key words mapping
 
 
@@ -61,130 +198,1367 @@ tags_to_insert = {
 }
 
 
-# insert tags into the database
+# upsert tags into the database and return the tag_type -> tag_name -> tag_id
+# lookup straight from RETURNING, so keyword sync needs no extra read of tags
 def bulk_insert_tags():
     print("Inserting tags into tags table...")
-    values = []
-    for tag_type, tag_names in tags_to_insert.items():
-        for name in tag_names:
-            safe_name = name.replace("'", "''")
-            safe_type = tag_type.replace("'", "''")
-            values.append(f"('{safe_name}', '{safe_type}')")
-
-    if values:
-        sql = f"""
-            INSERT INTO {DB_NAME}.tags (tag_name, tag_type)
-            VALUES {', '.join(values)}
-            ON CONFLICT DO NOTHING;
-        """
+    tag_types = []
+    tag_names = []
+    for tag_type, names in tags_to_insert.items():
+        for name in names:
+            tag_types.append(tag_type)
+            tag_names.append(name)
+
+    tag_lookup = defaultdict(dict)
+    if tag_names:
         with engine.begin() as conn:
-            conn.execute(text(sql))
+            result = conn.execute(
+                text(f"""
+                    INSERT INTO {DB_NAME}.tags (tag_name, tag_type)
+                    SELECT * FROM unnest(CAST(:tag_names AS text[]), CAST(:tag_types AS text[]))
+                    ON CONFLICT (tag_name, tag_type) DO UPDATE
+                    SET tag_type = EXCLUDED.tag_type
+                    RETURNING tag_id, tag_name, tag_type;
+                """),
+                {"tag_names": tag_names, "tag_types": tag_types},
+            ).mappings()
+            for row in result:
+                tag_lookup[row["tag_type"]][row["tag_name"]] = row["tag_id"]
 
     print("Tags inserted into tags table.")
+    return tag_lookup
+
+
+# tag_type -> {tag_name: [keywords]} dictionaries from keywords.py
+KEYWORD_DICTIONARIES = [
+    ("holiday", holiday_keywords),
+    ("cuisine", cuisine_keywords),
+    ("diet", diet_keywords),
+    ("region", region_keywords),
+    ("course", course_keywords),
+]
+
 
+# (tag_id, keyword) pairs described by keywords.py, resolved against tags
+def desired_tag_keywords(tag_lookup):
+    desired = set()
+    for tag_type, tag_dict in KEYWORD_DICTIONARIES:
+        for tag_name, keywords in tag_dict.items():
+            tag_id = tag_lookup.get(tag_type, {}).get(tag_name)
+            if not tag_id:
+                print(f"Tag '{tag_name}' with type '{tag_type}' not found in tags table.")
+                continue
 
-# insert keywords into tag_keywords table
-def bulk_insert_keywords():
-    print("Inserting keywords into tag_keywords...")
+            for keyword in keywords:
+                desired.add((tag_id, keyword))
+    return desired
+
+
+# sync tag_keywords with keywords.py: diff against the current rows and only
+# insert what is missing and (with prune) delete what keywords.py no longer
+# lists, passing the rows as unnest arrays. Mappings produced by a deleted
+# keyword are dropped in the same transaction. Returns the keyword rows that
+# were actually new, and optionally tags recipes with just those.
+# Pass the lookup returned by bulk_insert_tags to skip re-reading tags.
+def bulk_insert_keywords(retag_new=False, prune=True, tag_lookup=None):
+    print("Syncing keywords into tag_keywords...")
+    new_keywords = []
+    removed_keywords = []
+    removed_mappings = 0
+    setup_database()
     with engine.begin() as conn:
-        tag_lookup = get_all_tag_ids(conn)
+        if tag_lookup is None:
+            tag_lookup = get_all_tag_ids(conn)
+        desired = desired_tag_keywords(tag_lookup)
+        current = set(
+            conn.execute(
+                text(f"SELECT tag_id, keyword FROM {DB_NAME}.tag_keywords")
+            ).fetchall()
+        )
 
-        values = []
+        additions = sorted(desired - current)
+        removals = sorted(current - desired) if prune else []
 
-        for tag_type, tag_dict in [
-            ("holiday", holiday_keywords),
-            ("cuisine", cuisine_keywords),
-            ("diet", diet_keywords),
-            ("region", region_keywords),
-            ("course", course_keywords),
-        ]:
-            for tag_name, keywords in tag_dict.items():
-                tag_id = tag_lookup.get(tag_type, {}).get(tag_name)
-                if not tag_id:
-                    print(f"Tag '{tag_name}' with type '{tag_type}' not found in tags table.")
-                    continue
+        if additions:
+            result = conn.execute(
+                text(f"""
+                    INSERT INTO {DB_NAME}.tag_keywords (tag_id, keyword)
+                    SELECT * FROM unnest(CAST(:tag_ids AS bigint[]), CAST(:keywords AS text[]))
+                    ON CONFLICT DO NOTHING
+                    RETURNING keyword_id, tag_id, keyword;
+                """),
+                {
+                    "tag_ids": [tag_id for tag_id, _ in additions],
+                    "keywords": [keyword for _, keyword in additions],
+                },
+            )
+            new_keywords = [dict(row) for row in result.mappings()]
 
+        if removals:
+            result = conn.execute(
+                text(f"""
+                    DELETE FROM {DB_NAME}.tag_keywords k
+                    USING unnest(CAST(:tag_ids AS bigint[]), CAST(:keywords AS text[]))
+                        AS removed(tag_id, keyword)
+                    WHERE k.tag_id = removed.tag_id AND k.keyword = removed.keyword
+                    RETURNING k.keyword_id, k.tag_id, k.keyword;
+                """),
+                {
+                    "tag_ids": [tag_id for tag_id, _ in removals],
+                    "keywords": [keyword for _, keyword in removals],
+                },
+            )
+            removed_keywords = [dict(row) for row in result.mappings()]
+            removed_mappings = drop_keyword_mappings(
+                conn, [row["keyword_id"] for row in removed_keywords]
+            )
+
+        if new_keywords or removed_keywords:
+            bump_keyword_version(conn)
+            refresh_tag_patterns(conn)
+
+    print(
+        f"Keywords synced into tag_keywords ({len(new_keywords)} new, "
+        f"{len(removed_keywords)} removed, {removed_mappings} mappings dropped)."
+    )
+    if retag_new and new_keywords:
+        tag_recipes_for_keywords(new_keywords)
+    return new_keywords
+
+TAGGING_MODES = ("regex", "automaton", "fts", "trgm", "pattern")
+
+
+# Database-free classification for previews: a matcher compiled straight from
+# keywords.py, keyed by (tag_type, tag_name), built once per process. It
+# reflects keywords.py as deployed, not edits made in tag_keywords since.
+_dictionary_matcher = None
+
+
+def get_dictionary_matcher():
+    global _dictionary_matcher
+    if _dictionary_matcher is None:
+        matcher = KeywordMatcher()
+        for tag_type, tag_dict in KEYWORD_DICTIONARIES:
+            for tag_name, keywords in tag_dict.items():
                 for keyword in keywords:
-                    # Properly escape single quotes
-                    safe_keyword = keyword.replace("'", "''")
-                    values.append(f"({tag_id}, '{safe_keyword}')")
-
-        if values:
-            sql = f"""
-                INSERT INTO {DB_NAME}.tag_keywords (tag_id, keyword)
-                VALUES {', '.join(values)}
-                ON CONFLICT DO NOTHING;
-            """
-            conn.execute(text(sql))
-
-    print("Keywords inserted into tag_keywords.")
-
-# tag all recipes based on keywords
-def auto_tag_recipes():
-    print("Auto-tagging recipes based on keywords")
+                    matcher.add(keyword, (tag_type, tag_name), tag_type)
+        matcher.compile()
+        _dictionary_matcher = matcher
+    return _dictionary_matcher
+
+
+# tag_type -> tag names matched in raw text, in order of first appearance
+def classify_text(value):
+    matches = get_dictionary_matcher().match_details(normalize_text(value))
+    grouped = defaultdict(list)
+    for (tag_type, tag_name), _ in sorted(matches.items(), key=lambda item: item[1][1]):
+        grouped[tag_type].append(tag_name)
+    return dict(grouped)
+
+
+# Catalog lookups, so provisioning only runs DDL (and takes its locks) for
+# objects that are actually missing
+def _relation_exists(conn, name):
+    return conn.execute(
+        text("SELECT to_regclass(:name) IS NOT NULL"), {"name": f"{DB_NAME}.{name}"}
+    ).scalar()
+
+
+def _column_exists(conn, table, column):
+    return conn.execute(
+        text("""
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = :schema AND table_name = :table AND column_name = :column
+            )
+        """),
+        {"schema": DB_NAME, "table": table, "column": column},
+    ).scalar()
+
+
+# provolatile of a function in our schema ('i', 's' or 'v'), None if missing
+def _function_volatility(conn, name):
+    return conn.execute(
+        text("""
+            SELECT p.provolatile
+            FROM pg_proc p
+            JOIN pg_namespace n ON n.oid = p.pronamespace
+            WHERE n.nspname = :schema AND p.proname = :name
+        """),
+        {"schema": DB_NAME, "name": name},
+    ).scalar()
+
+
+def _trigger_exists(conn, table, name):
+    return conn.execute(
+        text("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_trigger
+                WHERE tgrelid = to_regclass(:table) AND tgname = :name
+            )
+        """),
+        {"table": f"{DB_NAME}.{table}", "name": name},
+    ).scalar()
+
+
+def _extension_exists(conn, name):
+    return conn.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = :name)"),
+        {"name": name},
+    ).scalar()
+
+
+# Normalized recipe names: recipe.recipe_name_norm holds the accent-stripped,
+# case-folded, punctuation-collapsed name, kept current by a trigger so the
+# cost is paid once per recipe write. Every matcher compares it against
+# keywords run through the same tagger_normalize() (matcher.normalize_text in
+# Python). The function is STABLE rather than IMMUTABLE because unaccent()
+# depends on its dictionary.
+def ensure_normalized_names(conn):
+    if not _extension_exists(conn, "unaccent"):
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent;"))
+    if _function_volatility(conn, "tagger_normalize") != "s":
+        conn.execute(
+            text(f"""
+                CREATE OR REPLACE FUNCTION {DB_NAME}.tagger_normalize(value text)
+                RETURNS text
+                LANGUAGE sql STABLE PARALLEL SAFE
+                AS $$
+                    SELECT btrim(regexp_replace(lower(unaccent(coalesce(value, ''))), '\\W+', ' ', 'g'))
+                $$;
+            """)
+        )
+
+    backfill = False
+    if not _column_exists(conn, "recipe", "recipe_name_norm"):
+        conn.execute(
+            text(f"""
+                ALTER TABLE {DB_NAME}.recipe
+                ADD COLUMN IF NOT EXISTS recipe_name_norm text;
+            """)
+        )
+        backfill = True
+
+    if _function_volatility(conn, "recipe_name_norm_trigger") is None:
+        conn.execute(
+            text(f"""
+                CREATE OR REPLACE FUNCTION {DB_NAME}.recipe_name_norm_trigger()
+                RETURNS trigger
+                LANGUAGE plpgsql
+                AS $$
+                BEGIN
+                    NEW.recipe_name_norm := {DB_NAME}.tagger_normalize(NEW.recipe_name);
+                    RETURN NEW;
+                END
+                $$;
+            """)
+        )
+    if not _trigger_exists(conn, "recipe", "recipe_name_norm_trg"):
+        conn.execute(
+            text(f"""
+                CREATE TRIGGER recipe_name_norm_trg
+                BEFORE INSERT OR UPDATE OF recipe_name ON {DB_NAME}.recipe
+                FOR EACH ROW EXECUTE FUNCTION {DB_NAME}.recipe_name_norm_trigger();
+            """)
+        )
+
+    if backfill:
+        conn.execute(
+            text(f"""
+                UPDATE {DB_NAME}.recipe
+                SET recipe_name_norm = {DB_NAME}.tagger_normalize(recipe_name)
+                WHERE recipe_name_norm IS NULL;
+            """)
+        )
+
+
+# Match provenance: every tag_keywords row gets a stable keyword_id, and each
+# recipe_tags_mapping row records the keyword_id that produced it plus the
+# match offset in recipe_name_norm (NULL when the match came from the
+# instructions). Mappings with a NULL keyword_id predate provenance or were
+# added by hand; the targeted cleanups leave them alone and only an explicit
+# reconcile_recipe_tags() run removes the ones no keyword justifies.
+def ensure_mapping_provenance(conn):
+    if not _column_exists(conn, "tag_keywords", "keyword_id"):
+        conn.execute(
+            text(f"""
+                ALTER TABLE {DB_NAME}.tag_keywords
+                ADD COLUMN IF NOT EXISTS keyword_id bigint GENERATED BY DEFAULT AS IDENTITY;
+            """)
+        )
+    if not _relation_exists(conn, "tag_keywords_keyword_id_idx"):
+        conn.execute(
+            text(f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS tag_keywords_keyword_id_idx
+                ON {DB_NAME}.tag_keywords (keyword_id);
+            """)
+        )
+    if not (
+        _column_exists(conn, "recipe_tags_mapping", "keyword_id")
+        and _column_exists(conn, "recipe_tags_mapping", "match_offset")
+    ):
+        conn.execute(
+            text(f"""
+                ALTER TABLE {DB_NAME}.recipe_tags_mapping
+                ADD COLUMN IF NOT EXISTS keyword_id bigint,
+                ADD COLUMN IF NOT EXISTS match_offset integer;
+            """)
+        )
+    if not _relation_exists(conn, "recipe_tags_mapping_keyword_id_idx"):
+        conn.execute(
+            text(f"""
+                CREATE INDEX IF NOT EXISTS recipe_tags_mapping_keyword_id_idx
+                ON {DB_NAME}.recipe_tags_mapping (keyword_id)
+                WHERE keyword_id IS NOT NULL;
+            """)
+        )
+
+
+# Schema provisioning is an explicit step: main.py runs it first, and so do
+# the batch entry points (keyword sync, reconciliation, auto-tagging), but the
+# per-recipe request path never does and assumes it has run once per
+# deployment. It runs in its own transaction under an advisory xact lock, so
+# concurrent callers wait for each other instead of racing on DDL, and the
+# process only remembers the schema as ready after that transaction commits.
+# The extra columns and indexes of the index-driven tagging modes are opt-in:
+# pass those modes to provision them too (auto_tag_recipes does for its mode).
+SCHEMA_LOCK_KEY = int(os.getenv("SCHEMA_LOCK_KEY", "7310416"))
+_schema_ready = False
+_mode_schema_ready = set()
+
+
+def setup_database(modes=()):
+    global _schema_ready
+    modes = [mode for mode in modes if mode in _MODE_SCHEMA and mode not in _mode_schema_ready]
+    if _schema_ready and not modes:
+        return
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        if not _schema_ready:
+            ensure_normalized_names(conn)
+            ensure_mapping_provenance(conn)
+            ensure_keyword_version_table(conn)
+            ensure_tagging_state_table(conn)
+            ensure_tag_patterns_table(conn)
+        for mode in modes:
+            _MODE_SCHEMA[mode](conn)
+    _schema_ready = True
+    _mode_schema_ready.update(modes)
+    print("Tagging schema is set up.")
+
+
+# offset of the first word-bounded match of k.keyword in r.recipe_name_norm;
+# both sides are normalized, so word boundaries are exactly the single spaces
+_MATCH_OFFSET_SQL = "strpos(' ' || r.recipe_name_norm || ' ', ' ' || k.keyword || ' ') - 1"
+
+# bulk writers fill in provenance for mappings tagged before it was recorded
+_MAPPING_CONFLICT_SQL = f"""
+    ON CONFLICT (recipe_id, tag_id) DO UPDATE
+    SET keyword_id = EXCLUDED.keyword_id, match_offset = EXCLUDED.match_offset
+    WHERE {DB_NAME}.recipe_tags_mapping.keyword_id IS NULL
+"""
+
+
+# SQL twin of matcher.truncate_at_word + normalize_text for the instruction
+# scan of include_instructions runs: the first :instruction_chars characters
+# of r.instructions, minus any word cut in half, normalized
+_INSTRUCTION_SCAN_SQL = f"""
+    {DB_NAME}.tagger_normalize(
+        CASE
+            WHEN substr(r.instructions, CAST(:instruction_chars AS integer) + 1, 1) ~ '\\w'
+            THEN regexp_replace(left(r.instructions, :instruction_chars), '\\w+$', '')
+            ELSE left(r.instructions, :instruction_chars)
+        END
+    )
+"""
+
+
+# Targeted cleanup after keyword deletion: delete the mappings the removed
+# keywords produced, then put back the (recipe, tag) pairs that a remaining
+# keyword of the same tag still matches, with that keyword as their
+# provenance. Pairs that came from the name are re-checked against the name;
+# pairs an include_instructions run found (NULL match_offset) are re-checked
+# against the name and then the scanned part of the instructions.
+# Returns the number of mappings that were really removed.
+def drop_keyword_mappings(conn, keyword_ids):
+    if not keyword_ids:
+        return 0
+    stale = conn.execute(
+        text(f"""
+            DELETE FROM {DB_NAME}.recipe_tags_mapping
+            WHERE keyword_id = ANY(CAST(:keyword_ids AS bigint[]))
+            RETURNING recipe_id, tag_id, match_offset IS NULL AS from_instructions;
+        """),
+        {"keyword_ids": list(keyword_ids)},
+    ).fetchall()
+    if not stale:
+        return 0
+
+    kept = conn.execute(
+        text(f"""
+            WITH stale AS (
+                SELECT *
+                FROM unnest(
+                    CAST(:rids AS bigint[]),
+                    CAST(:tids AS bigint[]),
+                    CAST(:from_instructions AS boolean[])
+                ) AS stale(recipe_id, tag_id, from_instructions)
+            ),
+            k AS MATERIALIZED (
+                SELECT keyword_id, tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                FROM {DB_NAME}.tag_keywords
+                WHERE tag_id IN (SELECT tag_id FROM stale)
+            ),
+            candidates AS (
+                SELECT
+                    r.recipe_id,
+                    k.tag_id,
+                    k.keyword_id,
+                    CASE
+                        WHEN r.recipe_name_norm ~ ('\\m' || k.keyword || '\\M')
+                        THEN {_MATCH_OFFSET_SQL}
+                    END AS match_offset,
+                    r.recipe_name_norm ~ ('\\m' || k.keyword || '\\M')
+                        OR (
+                            s.from_instructions
+                            AND {_INSTRUCTION_SCAN_SQL} ~ ('\\m' || k.keyword || '\\M')
+                        ) AS matched
+                FROM
+                    stale s
+                JOIN
+                    {DB_NAME}.recipe r ON r.recipe_id = s.recipe_id
+                JOIN
+                    k ON k.tag_id = s.tag_id
+                WHERE
+                    k.keyword <> ''
+            )
+            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+            SELECT DISTINCT ON (recipe_id, tag_id)
+                recipe_id,
+                tag_id,
+                keyword_id,
+                match_offset
+            FROM candidates
+            WHERE matched
+            ORDER BY recipe_id, tag_id, match_offset NULLS LAST, keyword_id
+            ON CONFLICT DO NOTHING;
+        """),
+        {
+            "rids": [row[0] for row in stale],
+            "tids": [row[1] for row in stale],
+            "from_instructions": [row[2] for row in stale],
+            "instruction_chars": INSTRUCTION_SCAN_CHARS,
+        },
+    )
+    return len(stale) - kept.rowcount
+
+
+# Reconciliation: delete every mapping that no remaining keyword justifies.
+# A mapping whose keyword_id still exists in tag_keywords is kept (it may have
+# come from the instructions); one with a NULL or dangling keyword_id is kept
+# only if some keyword of its tag still matches the recipe name. Unlike the
+# targeted cleanups this also removes legacy and hand-added mappings, so it
+# only runs on request. Returns the number of mappings deleted.
+def delete_unjustified_mappings(conn):
+    result = conn.execute(
+        text(f"""
+            WITH k AS MATERIALIZED (
+                SELECT tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                FROM {DB_NAME}.tag_keywords
+            )
+            DELETE FROM {DB_NAME}.recipe_tags_mapping m
+            WHERE
+                NOT EXISTS (
+                    SELECT 1 FROM {DB_NAME}.tag_keywords tk
+                    WHERE tk.keyword_id = m.keyword_id
+                )
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM {DB_NAME}.recipe r
+                    JOIN k ON k.tag_id = m.tag_id
+                    WHERE
+                        r.recipe_id = m.recipe_id
+                        AND k.keyword <> ''
+                        AND r.recipe_name_norm ~ ('\\m' || k.keyword || '\\M')
+                );
+        """)
+    )
+    return result.rowcount
+
+
+# sync keywords with pruning, then drop the mappings the pruned (or any other
+# vanished) keywords left behind, without redoing the full tagging run
+def reconcile_recipe_tags(tag_lookup=None):
+    bulk_insert_keywords(prune=True, tag_lookup=tag_lookup)
+    print("Reconciling recipe_tags_mapping with tag_keywords...")
     with engine.begin() as conn:
         startTime = time.time()
-        conn.execute(text("SET statement_timeout TO '1200000';"))
+        removed = delete_unjustified_mappings(conn)
+        endTime = time.time()
+    print(f"Removed {removed} stale mappings in {endTime - startTime:.2f} seconds.")
+    return removed
+
+
+# keywords come back already run through tagger_normalize(), so the matcher
+# compares them with recipe_name_norm exactly as the SQL modes do
+def fetch_keyword_rows(conn):
+    return conn.execute(
+        text(f"""
+            SELECT k.keyword_id, k.tag_id, {DB_NAME}.tagger_normalize(k.keyword) AS keyword, t.tag_type
+            FROM {DB_NAME}.tag_keywords k
+            JOIN {DB_NAME}.tags t ON t.tag_id = k.tag_id
+        """)
+    ).mappings().fetchall()
+
+
+def build_keyword_matcher(conn):
+    return KeywordMatcher.from_rows(fetch_keyword_rows(conn), normalized=True)
+
+
+# Keyword version stamp: bumped whenever tag_keywords changes so processes
+# can tell if their compiled matcher is stale with one single-row read.
+def ensure_keyword_version_table(conn):
+    if _relation_exists(conn, "tag_keywords_version"):
+        return
+    conn.execute(
+        text(f"""
+            CREATE TABLE IF NOT EXISTS {DB_NAME}.tag_keywords_version (
+                id smallint PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                version bigint NOT NULL DEFAULT 0
+            );
+        """)
+    )
+    conn.execute(
+        text(f"""
+            INSERT INTO {DB_NAME}.tag_keywords_version (id, version)
+            VALUES (1, 0)
+            ON CONFLICT DO NOTHING;
+        """)
+    )
+
+
+def fetch_keyword_version(conn):
+    return conn.execute(
+        text(f"SELECT version FROM {DB_NAME}.tag_keywords_version WHERE id = 1")
+    ).scalar()
+
+
+def bump_keyword_version(conn):
+    conn.execute(
+        text(f"UPDATE {DB_NAME}.tag_keywords_version SET version = version + 1 WHERE id = 1")
+    )
+
+
+# process-wide compiled matcher, rebuilt only when the keyword version moves
+_matcher_cache = {"version": None, "matcher": None}
+_matcher_lock = threading.Lock()
+
+
+# (no database work happens under the lock, so this is also safe to call
+# from the async path via run_sync, where a blocked lock would stall the loop)
+def get_keyword_matcher(conn):
+    version = fetch_keyword_version(conn)
+    with _matcher_lock:
+        if _matcher_cache["matcher"] is not None and _matcher_cache["version"] == version:
+            return _matcher_cache["matcher"]
+
+    matcher = build_keyword_matcher(conn)
+    with _matcher_lock:
+        _matcher_cache["matcher"] = matcher
+        _matcher_cache["version"] = version
+    print(f"Compiled keyword matcher at version {version}.")
+    return matcher
+
+
+# High-water mark of the last successful auto-tagging run, so incremental runs
+# only look at recipes added since then.
+def ensure_tagging_state_table(conn):
+    if _relation_exists(conn, "tagging_state"):
+        return
+    conn.execute(
+        text(f"""
+            CREATE TABLE IF NOT EXISTS {DB_NAME}.tagging_state (
+                name text PRIMARY KEY,
+                last_recipe_id bigint NOT NULL,
+                updated_at timestamptz NOT NULL DEFAULT now()
+            );
+        """)
+    )
+
+
+def fetch_last_tagged_recipe_id(conn):
+    last_id = conn.execute(
+        text(f"SELECT last_recipe_id FROM {DB_NAME}.tagging_state WHERE name = 'auto_tag'")
+    ).scalar()
+    return last_id or 0
+
+
+# never moves the mark backwards, e.g. while re-scanning the window below it
+def record_last_tagged_recipe_id(conn, recipe_id):
+    conn.execute(
+        text(f"""
+            INSERT INTO {DB_NAME}.tagging_state (name, last_recipe_id)
+            VALUES ('auto_tag', :rid)
+            ON CONFLICT (name) DO UPDATE
+            SET
+                last_recipe_id = greatest({DB_NAME}.tagging_state.last_recipe_id, EXCLUDED.last_recipe_id),
+                updated_at = now();
+        """),
+        {"rid": recipe_id},
+    )
+
+
+def _auto_tag_regex(conn, after_id, upto_id):
+    result = conn.execute(
+        text(f"""
+            WITH k AS MATERIALIZED (
+                SELECT keyword_id, tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                FROM {DB_NAME}.tag_keywords
+            )
+            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+            SELECT DISTINCT ON (r.recipe_id, k.tag_id)
+                r.recipe_id,
+                k.tag_id,
+                k.keyword_id,
+                {_MATCH_OFFSET_SQL} AS match_offset
+            FROM
+                {DB_NAME}.recipe r
+            JOIN
+                k
+            ON
+                r.recipe_name_norm ~ ('\\m' || k.keyword || '\\M')
+            WHERE
+                k.keyword <> ''
+                AND r.recipe_id > :after_id AND r.recipe_id <= :upto_id
+            ORDER BY r.recipe_id, k.tag_id, match_offset, k.keyword_id
+            {_MAPPING_CONFLICT_SQL};
+        """),
+        {"after_id": after_id, "upto_id": upto_id},
+    )
+    return result.rowcount
+
+
+# Bulk write path for (recipe_id, tag_id, keyword_id, match_offset) rows:
+# stream them with COPY into a transaction-scoped staging table, then merge
+# into recipe_tags_mapping with one set-based insert. Returns the number of
+# mappings written.
+def copy_recipe_tags(conn, rows):
+    if not rows:
+        return 0
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join("\\N" if value is None else str(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    conn.execute(
+        text("""
+            CREATE TEMP TABLE IF NOT EXISTS recipe_tags_staging (
+                recipe_id bigint NOT NULL,
+                tag_id bigint NOT NULL,
+                keyword_id bigint,
+                match_offset integer
+            ) ON COMMIT DROP;
+        """)
+    )
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY recipe_tags_staging (recipe_id, tag_id, keyword_id, match_offset) FROM STDIN",
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+    result = conn.execute(
+        text(f"""
+            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+            SELECT DISTINCT ON (recipe_id, tag_id) recipe_id, tag_id, keyword_id, match_offset
+            FROM recipe_tags_staging
+            ORDER BY recipe_id, tag_id, match_offset
+            {_MAPPING_CONFLICT_SQL};
+        """)
+    )
+    conn.execute(text("TRUNCATE recipe_tags_staging;"))
+    return result.rowcount
+
+
+# recipes are (recipe_id, recipe_name_norm) tuples, or (recipe_id,
+# recipe_name_norm, instructions) when instruction_chars is set, in which case
+# instructions are scanned up to that many characters for tag types the name
+# left unresolved. Returns (recipe_id, tag_id, keyword_id, match_offset) rows.
+def _match_recipes(matcher, recipes, instruction_chars=None):
+    if instruction_chars is None:
+        matches = ((recipe[0], matcher.match_details(recipe[1] or "")) for recipe in recipes)
+    else:
+        matches = (
+            (recipe[0], matcher.match_fields(recipe[1:], max_chars=instruction_chars))
+            for recipe in recipes
+        )
+    return [
+        (recipe_id, tag_id, keyword_id, offset)
+        for recipe_id, details in matches
+        for tag_id, (keyword_id, offset) in details.items()
+    ]
+
+
+# each pool worker unpickles the compiled matcher once and reuses it for
+# every shard it is handed
+_worker_matcher = None
+_worker_instruction_chars = None
+
+
+def _init_match_worker(matcher, instruction_chars=None):
+    global _worker_matcher, _worker_instruction_chars
+    # forked workers never touch the database; drop the inherited pool
+    # without closing the parent's connections
+    engine.dispose(close=False)
+    _worker_matcher = matcher
+    _worker_instruction_chars = instruction_chars
+
+
+def _match_recipes_in_worker(recipes):
+    return _match_recipes(_worker_matcher, recipes, _worker_instruction_chars)
+
+
+# Full-text mode: a stored tsvector of recipe_name_norm with a GIN index, matched
+# against phraseto_tsquery(keyword) so the planner can drive each keyword
+# through the index. Uses the 'simple' configuration (no stemming or stop
+# words) to stay close to the whole-word regex; tokenization of punctuation
+# still differs slightly, which is what the mode is there to compare.
+# Provisioned through setup_database(modes=("fts",)): adding the generated
+# column rewrites recipe under an ACCESS EXCLUSIVE lock, so it only happens
+# when the column is missing.
+def ensure_recipe_fts_index(conn):
+    if not _column_exists(conn, "recipe", "recipe_name_tsv"):
+        conn.execute(
+            text(f"""
+                ALTER TABLE {DB_NAME}.recipe
+                ADD COLUMN IF NOT EXISTS recipe_name_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('simple', coalesce(recipe_name_norm, ''))) STORED;
+            """)
+        )
+    if not _relation_exists(conn, "recipe_name_tsv_idx"):
         conn.execute(
             text(f"""
-                INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id)
+                CREATE INDEX IF NOT EXISTS recipe_name_tsv_idx
+                ON {DB_NAME}.recipe USING gin (recipe_name_tsv);
+            """)
+        )
+
+
+def _auto_tag_fts(conn, after_id, upto_id):
+    result = conn.execute(
+        text(f"""
+            WITH k AS MATERIALIZED (
                 SELECT
+                    keyword_id,
+                    tag_id,
+                    keyword,
+                    phraseto_tsquery('simple', keyword) AS query
+                FROM (
+                    SELECT keyword_id, tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                    FROM {DB_NAME}.tag_keywords
+                ) normalized
+            )
+            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+            SELECT DISTINCT ON (r.recipe_id, k.tag_id)
+                r.recipe_id,
+                k.tag_id,
+                k.keyword_id,
+                {_MATCH_OFFSET_SQL} AS match_offset
+            FROM
+                k
+            JOIN
+                {DB_NAME}.recipe r
+            ON
+                r.recipe_name_tsv @@ k.query
+            WHERE
+                numnode(k.query) > 0
+                AND r.recipe_id > :after_id AND r.recipe_id <= :upto_id
+            ORDER BY r.recipe_id, k.tag_id, match_offset, k.keyword_id
+            {_MAPPING_CONFLICT_SQL};
+        """),
+        {"after_id": after_id, "upto_id": upto_id},
+    )
+    return result.rowcount
+
+
+# Trigram mode: a pg_trgm GIN index on recipe_name_norm lets each keyword
+# fetch its candidate recipes with a LIKE '%keyword%' probe, and only those
+# candidates pay for the word-boundary regex. Keywords shorter than three
+# characters have no trigrams and fall back to scanning the range.
+# Provisioned through setup_database(modes=("trgm",)).
+def ensure_recipe_trgm_index(conn):
+    if not _extension_exists(conn, "pg_trgm"):
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm;"))
+    if not _relation_exists(conn, "recipe_name_trgm_idx"):
+        conn.execute(
+            text(f"""
+                CREATE INDEX IF NOT EXISTS recipe_name_trgm_idx
+                ON {DB_NAME}.recipe USING gin (recipe_name_norm gin_trgm_ops);
+            """)
+        )
+
+
+def _auto_tag_trgm(conn, after_id, upto_id):
+    result = conn.execute(
+        text(f"""
+            WITH k AS MATERIALIZED (
+                SELECT keyword_id, tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                FROM {DB_NAME}.tag_keywords
+            )
+            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+            SELECT DISTINCT ON (r.recipe_id, k.tag_id)
+                r.recipe_id,
+                k.tag_id,
+                k.keyword_id,
+                {_MATCH_OFFSET_SQL} AS match_offset
+            FROM
+                k
+            CROSS JOIN LATERAL (
+                SELECT recipe_id, recipe_name_norm
+                FROM {DB_NAME}.recipe
+                WHERE
+                    recipe_name_norm LIKE ('%' || replace(k.keyword, '_', '\\_') || '%')
+                    AND recipe_name_norm ~ ('\\m' || k.keyword || '\\M')
+                    AND recipe_id > :after_id AND recipe_id <= :upto_id
+            ) r
+            WHERE
+                k.keyword <> ''
+            ORDER BY r.recipe_id, k.tag_id, match_offset, k.keyword_id
+            {_MAPPING_CONFLICT_SQL};
+        """),
+        {"after_id": after_id, "upto_id": upto_id},
+    )
+    return result.rowcount
+
+
+# Pattern mode: one combined \m(kw1|kw2|...)\M regex per tag, stored in
+# tag_patterns, so each recipe is tested once per tag instead of once per
+# keyword. Normalized keywords hold only word characters and single spaces,
+# so they need no regex escaping inside the alternation; the capture group
+# tells which keyword matched, for provenance.
+def ensure_tag_patterns_table(conn):
+    if _relation_exists(conn, "tag_patterns"):
+        return
+    conn.execute(
+        text(f"""
+            CREATE TABLE IF NOT EXISTS {DB_NAME}.tag_patterns (
+                tag_id bigint PRIMARY KEY,
+                pattern text NOT NULL
+            );
+        """)
+    )
+
+
+def refresh_tag_patterns(conn):
+    conn.execute(text(f"DELETE FROM {DB_NAME}.tag_patterns;"))
+    conn.execute(
+        text(f"""
+            INSERT INTO {DB_NAME}.tag_patterns (tag_id, pattern)
+            SELECT
+                tag_id,
+                '\\m(' || string_agg(keyword, '|' ORDER BY keyword) || ')\\M'
+            FROM (
+                SELECT DISTINCT tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                FROM {DB_NAME}.tag_keywords
+            ) k
+            WHERE keyword <> ''
+            GROUP BY tag_id;
+        """)
+    )
+
+
+def ensure_tag_patterns(conn):
+    if conn.execute(text(f"SELECT 1 FROM {DB_NAME}.tag_patterns LIMIT 1")).first() is None:
+        refresh_tag_patterns(conn)
+
+
+def _auto_tag_pattern(conn, after_id, upto_id):
+    result = conn.execute(
+        text(f"""
+            WITH m AS (
+                SELECT recipe_id, tag_id, recipe_name_norm, keyword
+                FROM (
+                    SELECT
+                        r.recipe_id,
+                        p.tag_id,
+                        r.recipe_name_norm,
+                        substring(r.recipe_name_norm FROM p.pattern) AS keyword
+                    FROM
+                        {DB_NAME}.recipe r
+                    CROSS JOIN
+                        {DB_NAME}.tag_patterns p
+                    WHERE
+                        r.recipe_id > :after_id AND r.recipe_id <= :upto_id
+                ) candidates
+                WHERE keyword IS NOT NULL
+            ),
+            k AS MATERIALIZED (
+                SELECT keyword_id, tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                FROM {DB_NAME}.tag_keywords
+            )
+            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+            SELECT DISTINCT ON (m.recipe_id, m.tag_id)
+                m.recipe_id,
+                m.tag_id,
+                k.keyword_id,
+                strpos(' ' || m.recipe_name_norm || ' ', ' ' || m.keyword || ' ') - 1
+            FROM
+                m
+            LEFT JOIN
+                k ON k.tag_id = m.tag_id AND k.keyword = m.keyword
+            ORDER BY m.recipe_id, m.tag_id, k.keyword_id
+            {_MAPPING_CONFLICT_SQL};
+        """),
+        {"after_id": after_id, "upto_id": upto_id},
+    )
+    return result.rowcount
+
+
+# set-based SQL taggers for one recipe_id range, and the setup each one needs
+_SQL_TAGGERS = {
+    "regex": _auto_tag_regex,
+    "fts": _auto_tag_fts,
+    "trgm": _auto_tag_trgm,
+    "pattern": _auto_tag_pattern,
+}
+# schema each index-driven mode needs, provisioned by setup_database(modes=...)
+_MODE_SCHEMA = {
+    "fts": ensure_recipe_fts_index,
+    "trgm": ensure_recipe_trgm_index,
+}
+_MODE_INDEXES = {
+    "pattern": ensure_tag_patterns,
+}
+# modes whose per-keyword index probe searches the whole index regardless of
+# the recipe_id range, so chunking would repeat every probe once per chunk;
+# they tag the whole range in one statement instead
+_UNCHUNKED_MODES = ("fts", "trgm")
+
+
+# scan every recipe name once against all keywords compiled into one automaton;
+# without a pool batches are matched as they stream in, with one the chunk is
+# split into `shards` equal shards (one per worker) so every worker process
+# gets a share however the stream happened to be batched, and the results
+# are merged into one batched write. Returns (mappings written, recipes seen).
+def _auto_tag_automaton(
+    conn, matcher, after_id, upto_id, pool=None, instruction_chars=None, shards=1
+):
+    columns = ("recipe_name_norm",)
+    if instruction_chars is not None:
+        columns += ("instructions",)
+    batches = iter_recipes(conn, columns=columns, after_id=after_id, upto_id=upto_id)
+    if pool is None:
+        rows = []
+        scanned = 0
+        for batch in batches:
+            rows.extend(_match_recipes(matcher, batch, instruction_chars))
+            scanned += len(batch)
+    else:
+        recipes = [recipe for batch in batches for recipe in batch]
+        scanned = len(recipes)
+        shard_size = max(-(-len(recipes) // shards), 1)
+        parts = [recipes[i:i + shard_size] for i in range(0, len(recipes), shard_size)]
+        rows = [row for shard in pool.map(_match_recipes_in_worker, parts) for row in shard]
+
+    return copy_recipe_tags(conn, rows), scanned
+
+
+AUTO_TAG_CHUNK_SIZE = int(os.getenv("AUTO_TAG_CHUNK_SIZE", "5000"))
+AUTO_TAG_WORKERS = int(os.getenv("AUTO_TAG_WORKERS", "1"))
+# upper bound for workers, since each one is a forked process
+MAX_AUTO_TAG_WORKERS = int(
+    os.getenv("MAX_AUTO_TAG_WORKERS", str(max(os.cpu_count() or 1, AUTO_TAG_WORKERS)))
+)
+INSTRUCTION_SCAN_CHARS = int(os.getenv("INSTRUCTION_SCAN_CHARS", "2000"))
+# incremental runs re-scan this many ids below the high-water mark (see
+# auto_tag_recipes)
+AUTO_TAG_RESCAN_WINDOW = int(os.getenv("AUTO_TAG_RESCAN_WINDOW", "1000"))
+
+
+def count_recipes(conn, after_id, upto_id):
+    return conn.execute(
+        text(f"""
+            SELECT count(*) FROM {DB_NAME}.recipe
+            WHERE recipe_id > :after_id AND recipe_id <= :upto_id
+        """),
+        {"after_id": after_id, "upto_id": upto_id},
+    ).scalar()
+
+
+# Single-run guard: full and incremental runs hold a session-level Postgres
+# advisory lock for their whole duration, so the API and main.py (or two API
+# workers) never tag at the same time. The lock sits on its own unpooled
+# connection, which keeps it from starving the "single" pool and releases it
+# automatically if the process dies.
+AUTO_TAG_LOCK_KEY = int(os.getenv("AUTO_TAG_LOCK_KEY", "7310415"))
+
+
+class TaggingRunInProgress(RuntimeError):
+    pass
+
+
+_lock_engine = None
+
+
+def get_lock_engine():
+    global _lock_engine
+    if _lock_engine is None:
+        _lock_engine = create_engine(sync_database_url(), poolclass=NullPool)
+    return _lock_engine
+
+
+def _try_advisory_lock(conn):
+    acquired = conn.execute(
+        text("SELECT pg_try_advisory_lock(:key)"), {"key": AUTO_TAG_LOCK_KEY}
+    ).scalar()
+    # don't leave the lock connection idle in a transaction for the whole run
+    conn.commit()
+    return acquired
+
+
+def _advisory_unlock(conn):
+    conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": AUTO_TAG_LOCK_KEY})
+    conn.commit()
+
+
+@contextmanager
+def auto_tag_lock():
+    with get_lock_engine().connect() as conn:
+        if not _try_advisory_lock(conn):
+            raise TaggingRunInProgress("Another auto-tagging run is already in progress")
+        try:
+            yield
+        finally:
+            _advisory_unlock(conn)
+
+
+# read-only probe for callers deciding whether to start a run: looks the lock
+# up in pg_locks instead of taking it, so a status check can never make a
+# real run fail to acquire it. A bigint advisory key shows up split into
+# classid (high half) and objid (low half) with objsubid 1.
+def auto_tag_running():
+    with engine.connect() as conn:
+        return conn.execute(
+            text("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_locks
+                    WHERE locktype = 'advisory'
+                        AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                        AND classid = CAST(:classid AS oid)
+                        AND objid = CAST(:objid AS oid)
+                        AND objsubid = 1
+                        AND granted
+                )
+            """),
+            {
+                "classid": (AUTO_TAG_LOCK_KEY >> 32) & 0xFFFFFFFF,
+                "objid": AUTO_TAG_LOCK_KEY & 0xFFFFFFFF,
+            },
+        ).scalar()
+
+
+def _run_auto_tag(
+    mode="regex",
+    incremental=False,
+    chunk_size=AUTO_TAG_CHUNK_SIZE,
+    workers=AUTO_TAG_WORKERS,
+    include_instructions=False,
+    job=None,
+):
+    if mode not in TAGGING_MODES:
+        raise ValueError(f"Unknown tagging mode '{mode}', expected one of {TAGGING_MODES}")
+    if not 1 <= workers <= MAX_AUTO_TAG_WORKERS:
+        raise ValueError(f"workers must be between 1 and {MAX_AUTO_TAG_WORKERS}")
+    if workers > 1 and mode != "automaton":
+        raise ValueError("Parallel workers are only supported in automaton mode")
+    if include_instructions and mode != "automaton":
+        raise ValueError("Instruction scanning is only supported in automaton mode")
+    instruction_chars = INSTRUCTION_SCAN_CHARS if include_instructions else None
+
+    print(f"Auto-tagging recipes based on keywords ({mode} mode)")
+    startTime = time.time()
+    setup_database(modes=(mode,))
+    with engine.begin() as conn:
+        after_id = 0
+        if incremental:
+            after_id = max(fetch_last_tagged_recipe_id(conn) - AUTO_TAG_RESCAN_WINDOW, 0)
+        upto_id = conn.execute(
+            text(f"SELECT coalesce(max(recipe_id), 0) FROM {DB_NAME}.recipe")
+        ).scalar()
+        total_recipes = count_recipes(conn, after_id, upto_id) if job is not None else None
+        matcher = build_keyword_matcher(conn) if mode == "automaton" else None
+        if mode in _MODE_INDEXES:
+            _MODE_INDEXES[mode](conn)
+    if job is not None:
+        job.set_total(total_recipes)
+
+    if upto_id <= after_id:
+        print(f"No recipes after recipe_id {after_id}, nothing to tag.")
+        return
+    print(f"Tagging recipes with recipe_id in ({after_id}, {upto_id}]")
+    if matcher is not None:
+        print(f"Compiled {len(matcher)} keywords into matcher.")
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_match_worker,
+            initargs=(matcher, instruction_chars),
+        )
+        print(f"Matching on {workers} worker processes.")
+
+    if mode in _UNCHUNKED_MODES:
+        chunk_size = upto_id - after_id
+
+    total = 0
+    chunk_start = after_id
+    try:
+        while chunk_start < upto_id:
+            chunk_end = min(chunk_start + chunk_size, upto_id)
+            chunkTime = time.time()
+            scanned = None
+            with engine.begin() as conn:
+                if mode == "automaton":
+                    written, scanned = _auto_tag_automaton(
+                        conn, matcher, chunk_start, chunk_end, pool, instruction_chars, workers
+                    )
+                else:
+                    written = _SQL_TAGGERS[mode](conn, chunk_start, chunk_end)
+                    if job is not None:
+                        scanned = count_recipes(conn, chunk_start, chunk_end)
+                record_last_tagged_recipe_id(conn, chunk_end)
+            # only after commit: with JOBS_PERSIST the job saves itself on its
+            # own connection, which a single-connection pool could not hand out
+            if job is not None:
+                job.advance(scanned, written)
+            total += written
+            progress = (chunk_end - after_id) / (upto_id - after_id) * 100
+            print(
+                f"Tagged recipe_id ({chunk_start}, {chunk_end}]: {written} mappings "
+                f"in {time.time() - chunkTime:.2f} seconds ({progress:.1f}%)"
+            )
+            chunk_start = chunk_end
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    endTime = time.time()
+    print(f"Auto-tagged recipes in {endTime - startTime:.2f} seconds ({total} mappings).")
+    print("Recipes auto-tagged based on keywords.")
+
+
+# tag all recipes based on keywords; incremental runs only cover recipes added
+# since the last successful run, a full run (the default) rebuilds everything.
+# Recipes are processed in recipe_id ranges of chunk_size, each committed on
+# its own together with the high-water mark, so a failure only loses the
+# current chunk and an incremental run picks up where it stopped. The
+# index-driven modes in _UNCHUNKED_MODES tag the whole range in one go.
+# Caveats for incremental runs: edited recipes aren't picked up (use the
+# per-recipe endpoints), and the mark is max(recipe_id) as seen when the run
+# started, so a recipe whose id was allocated earlier but committed only after
+# that would fall below it. Incremental runs therefore re-scan the last
+# AUTO_TAG_RESCAN_WINDOW ids below the mark (re-tagging is idempotent); a
+# transaction that stays open while more ids than that are handed out can
+# still slip through, and only a full run catches it.
+# In automaton mode, workers > 1 matches each chunk on a process pool, and
+# include_instructions also scans the first INSTRUCTION_SCAN_CHARS characters
+# of the instructions for tag types the recipe name did not resolve.
+# Pass a jobs.Job as job to have its progress updated after every chunk.
+# Raises TaggingRunInProgress if another run holds the lock.
+def auto_tag_recipes(
+    mode="regex",
+    incremental=False,
+    chunk_size=AUTO_TAG_CHUNK_SIZE,
+    workers=AUTO_TAG_WORKERS,
+    include_instructions=False,
+    job=None,
+):
+    with auto_tag_lock():
+        _run_auto_tag(mode, incremental, chunk_size, workers, include_instructions, job)
+
+
+# tag all recipes against only the given (tag_id, keyword) rows, e.g. the ones
+# bulk_insert_keywords just added, instead of re-running every keyword
+def tag_recipes_for_keywords(keyword_rows):
+    if not keyword_rows:
+        return
+    print(f"Tagging recipes for {len(keyword_rows)} keywords...")
+    setup_database()
+    with engine.begin() as conn:
+        startTime = time.time()
+        conn.execute(
+            text(f"""
+                WITH k AS MATERIALIZED (
+                    SELECT keyword_id, tag_id, {DB_NAME}.tagger_normalize(keyword) AS keyword
+                    FROM unnest(
+                        CAST(:keyword_ids AS bigint[]),
+                        CAST(:tag_ids AS bigint[]),
+                        CAST(:keywords AS text[])
+                    ) AS new_keywords(keyword_id, tag_id, keyword)
+                )
+                INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+                SELECT DISTINCT ON (r.recipe_id, k.tag_id)
                     r.recipe_id,
-                    k.tag_id
+                    k.tag_id,
+                    k.keyword_id,
+                    {_MATCH_OFFSET_SQL} AS match_offset
                 FROM
                     {DB_NAME}.recipe r
                 JOIN
-                    {DB_NAME}.tag_keywords k
+                    k
                 ON
-                    lower(r.recipe_name) ~* ('\\m' || lower(k.keyword) || '\\M')
-                ON CONFLICT DO NOTHING;
-            """)
+                    r.recipe_name_norm ~ ('\\m' || k.keyword || '\\M')
+                WHERE
+                    k.keyword <> ''
+                ORDER BY r.recipe_id, k.tag_id, match_offset, k.keyword_id
+                {_MAPPING_CONFLICT_SQL};
+            """),
+            {
+                "keyword_ids": [row["keyword_id"] for row in keyword_rows],
+                "tag_ids": [row["tag_id"] for row in keyword_rows],
+                "keywords": [row["keyword"] for row in keyword_rows],
+            },
         )
         endTime = time.time()
-        print(f"Auto-tagged recipes in {endTime - startTime:.2f} seconds.")
-    print("Recipes auto-tagged based on keywords.")
+        print(f"Tagged recipes for new keywords in {endTime - startTime:.2f} seconds.")
+
+
+# returns the matched, newly added and removed tag ids, or None if the recipe
+# does not exist
+def _tag_recipe_by_id(conn, recipe_id):
+    result = _tag_recipes_by_ids(conn, [recipe_id])[0]
+    if not result.pop("found"):
+        print(f"Recipe with ID {recipe_id} not found.")
+        return None
+    return result
 
-# tag a specific recipe by ID based on keywords
-def tag_recipe(conn, recipe_id, tag_id):
-    exists = conn.execute(
-        text(
-            f"""
-        SELECT 1 FROM {DB_NAME}.recipe_tags_mapping WHERE recipe_id = :rid AND tag_id = :tid
-    """
-        ),
-        {"rid": recipe_id, "tid": tag_id},
-    ).first()
-
-    if not exists:
+
+def tag_recipe_by_id(recipe_id):
+    with engine.begin() as conn:
+        return _tag_recipe_by_id(conn, recipe_id)
+
+
+# Batch variant of _tag_recipe_by_id: one query for all recipe names, one pass
+# per name over the cached matcher and one multi-row upsert for every mapping.
+# The recipes are re-evaluated, so after an edit the name-derived mappings
+# that no longer match are deleted and the rest get their provenance updated;
+# mappings without a keyword_id (legacy or manual) and those found in the
+# instructions (NULL match_offset) are left alone, since only the name is
+# scanned here.
+# Returns one result per requested id, in request order.
+def _tag_recipes_by_ids(conn, recipe_ids):
+    recipe_ids = list(dict.fromkeys(recipe_ids))
+    if not recipe_ids:
+        return []
+    names = dict(
         conn.execute(
-            text(
-                f"""
-            INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id) VALUES (:rid, :tid)
-        """
-            ),
-            {"rid": recipe_id, "tid": tag_id},
+            text(f"""
+                SELECT recipe_id, recipe_name_norm FROM {DB_NAME}.recipe
+                WHERE recipe_id = ANY(CAST(:rids AS bigint[]))
+            """),
+            {"rids": recipe_ids},
+        ).fetchall()
+    )
+
+    matcher = get_keyword_matcher(conn)
+    matched = {
+        recipe_id: matcher.match_details(name or "")
+        for recipe_id, name in names.items()
+    }
+    rows = [
+        (recipe_id, tag_id, keyword_id, offset)
+        for recipe_id, details in matched.items()
+        for tag_id, (keyword_id, offset) in details.items()
+    ]
+
+    removed = defaultdict(list)
+    added = defaultdict(list)
+    if names:
+        result = conn.execute(
+            text(f"""
+                DELETE FROM {DB_NAME}.recipe_tags_mapping m
+                WHERE
+                    m.recipe_id = ANY(CAST(:found AS bigint[]))
+                    AND m.keyword_id IS NOT NULL
+                    AND m.match_offset IS NOT NULL
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM unnest(CAST(:rids AS bigint[]), CAST(:tids AS bigint[]))
+                            AS matched(recipe_id, tag_id)
+                        WHERE matched.recipe_id = m.recipe_id AND matched.tag_id = m.tag_id
+                    )
+                RETURNING m.recipe_id, m.tag_id;
+            """),
+            {
+                "found": list(names),
+                "rids": [row[0] for row in rows],
+                "tids": [row[1] for row in rows],
+            },
         )
+        for recipe_id, tag_id in result:
+            removed[recipe_id].append(tag_id)
 
+    if rows:
+        result = conn.execute(
+            text(f"""
+                INSERT INTO {DB_NAME}.recipe_tags_mapping (recipe_id, tag_id, keyword_id, match_offset)
+                SELECT * FROM unnest(
+                    CAST(:rids AS bigint[]),
+                    CAST(:tids AS bigint[]),
+                    CAST(:kids AS bigint[]),
+                    CAST(:offsets AS integer[])
+                )
+                ON CONFLICT (recipe_id, tag_id) DO UPDATE
+                SET keyword_id = EXCLUDED.keyword_id, match_offset = EXCLUDED.match_offset
+                WHERE
+                    ({DB_NAME}.recipe_tags_mapping.keyword_id, {DB_NAME}.recipe_tags_mapping.match_offset)
+                    IS DISTINCT FROM (EXCLUDED.keyword_id, EXCLUDED.match_offset)
+                RETURNING recipe_id, tag_id, (xmax = 0) AS inserted;
+            """),
+            {
+                "rids": [row[0] for row in rows],
+                "tids": [row[1] for row in rows],
+                "kids": [row[2] for row in rows],
+                "offsets": [row[3] for row in rows],
+            },
+        )
+        for recipe_id, tag_id, inserted in result:
+            if inserted:
+                added[recipe_id].append(tag_id)
 
-def tag_recipe_by_id(recipe_id):
+    print(f"Tagged {len(names)} of {len(recipe_ids)} requested recipes ({len(rows)} mappings).")
+    return [
+        {
+            "recipe_id": recipe_id,
+            "found": recipe_id in names,
+            "tag_ids": sorted(matched.get(recipe_id, {})),
+            "added_tag_ids": sorted(added.get(recipe_id, [])),
+            "removed_tag_ids": sorted(removed.get(recipe_id, [])),
+        }
+        for recipe_id in recipe_ids
+    ]
+
+
+def tag_recipes_by_ids(recipe_ids):
     with engine.begin() as conn:
-        tag_map = fetch_all_tag_keywords(conn)
-        recipe = conn.execute(
-            text(
-                f"SELECT recipe_name FROM {DB_NAME}.recipe WHERE recipe_id = :rid"
-            ),
-            {"rid": recipe_id},
-        ).fetchone()
+        return _tag_recipes_by_ids(conn, recipe_ids)
+
 
-        if not recipe:
-            print(f"Recipe with ID {recipe_id} not found.")
-            return
+# Async variant for the web service: the same logic runs through run_sync on
+# an asyncpg connection, so many concurrent calls share one event loop instead
+# of each holding a threadpool worker for its database round trips.
+async def tag_recipe_by_id_async(recipe_id):
+    async with get_async_engine().begin() as conn:
+        return await conn.run_sync(_tag_recipe_by_id, recipe_id)
 
-        content = f"{recipe['recipe_name']}".lower()
 
-        for tag_id, keywords in tag_map.items():
-            if any(kw in content for kw in keywords):
-                tag_recipe(conn, recipe_id, tag_id)
-    print(f"Recipe {recipe_id} auto-tagged based on keywords.")
+async def tag_recipes_by_ids_async(recipe_ids):
+    async with get_async_engine().begin() as conn:
+        return await conn.run_sync(_tag_recipes_by_ids, recipe_ids)
 
 # 85198
\ No newline at end of file
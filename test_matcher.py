@@ -0,0 +1,127 @@
+import random
+import re
+
+from matcher import KeywordMatcher, normalize_text, truncate_at_word
+
+
+def build(keywords):
+    matcher = KeywordMatcher()
+    for keyword_id, (keyword, tag_id, tag_type) in enumerate(keywords, start=1):
+        matcher.add(keyword, tag_id, tag_type, keyword_id)
+    matcher.compile()
+    return matcher
+
+
+def test_keyword_must_be_whole_words():
+    matcher = build([("ham", 1, "holiday")])
+    assert matcher.match("honey ham") == {1}
+    assert matcher.match("ham and cheese") == {1}
+    assert matcher.match("graham crackers") == set()
+    assert matcher.match("hamburger") == set()
+    assert matcher.match("shame") == set()
+
+
+def test_overlapping_and_multi_word_keywords():
+    matcher = build([
+        ("sweet potato", 1, "course"),
+        ("sweet potato pie", 2, "course"),
+        ("potato", 3, "course"),
+        ("pie", 4, "course"),
+        ("potato pie", 5, "course"),
+    ])
+    assert matcher.match("sweet potato pie") == {1, 2, 3, 4, 5}
+    assert matcher.match("sweet potatoes") == set()
+    assert matcher.match("potato pies") == {3}
+
+
+def test_keywords_are_normalized_on_add():
+    matcher = build([("Crème Brûlée", 1, "course"), ("Sweet-Potato", 2, "course")])
+    assert matcher.match(normalize_text("Vanilla crème brûlée!")) == {1}
+    assert matcher.match(normalize_text("sweet potato mash")) == {2}
+
+
+def test_match_details_reports_first_match_and_keyword():
+    matcher = build([("ham", 1, "holiday"), ("glazed ham", 1, "holiday"), ("pie", 2, "course")])
+    details = matcher.match_details("pie with glazed ham")
+    assert details[2] == (3, 0)
+    # "glazed ham" ends first, at the same position as the inner "ham"
+    assert details[1] in {(2, 9), (1, 16)}
+    assert set(details) == {1, 2}
+
+
+def test_recompile_after_add_does_not_duplicate_matches():
+    matcher = build([("ham", 1, "holiday")])
+    matcher.match("ham")
+    matcher.add("honey ham", 2, "holiday", 99)
+    matches = list(matcher.iter_matches("honey ham"))
+    assert sorted(index for _, _, index in matches) == [0, 1]
+
+
+def test_matches_word_boundary_regex_reference():
+    rng = random.Random(7)
+    words = ["ham", "graham", "pie", "potato", "sweet", "a", "ab", "ba", "b"]
+    keywords = ["ham", "pie", "sweet potato", "a", "ab", "b a", "potato pie"]
+    matcher = build([(keyword, index, "course") for index, keyword in enumerate(keywords)])
+    for _ in range(300):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+        expected = {
+            index
+            for index, keyword in enumerate(keywords)
+            if re.search(r"(?<!\w)" + re.escape(keyword) + r"(?!\w)", text)
+        }
+        assert matcher.match(text) == expected, text
+
+
+def test_normalize_text_matches_tagger_normalize():
+    assert normalize_text("  Crème   Brûlée!! ") == "creme brulee"
+    assert normalize_text("Mac & Cheese (Baked)") == "mac cheese baked"
+    assert normalize_text(None) == ""
+
+
+def test_normalize_text_transliterates_like_unaccent():
+    assert normalize_text("Gołąbki") == "golabki"
+    assert normalize_text("Mercimek Çorbası") == "mercimek corbasi"
+    assert normalize_text("Smørrebrød") == "smorrebrod"
+    assert normalize_text("Straße") == "strasse"
+    assert normalize_text("Æbleskiver") == "aebleskiver"
+
+
+def test_truncate_at_word_never_leaves_a_partial_word():
+    assert truncate_at_word("hamburger", 3) == ""
+    assert truncate_at_word("honey ham steak", 9) == "honey ham"
+    assert truncate_at_word("honey ham steak", 8) == "honey "
+    assert truncate_at_word("honey ham", 50) == "honey ham"
+    assert truncate_at_word("honey ham", None) == "honey ham"
+
+
+def test_match_fields_scans_first_field_in_full():
+    matcher = build([
+        ("vegan", 1, "diet"),
+        ("dessert", 2, "course"),
+        ("salsa", 3, "course"),
+        ("mexican", 4, "diet"),
+    ])
+    name = "Vegan Dessert with Mexican Salsa"
+    details = matcher.match_fields([name, "vegan dessert"])
+    assert set(details) == matcher.match(normalize_text(name))
+    assert details[3] == (3, normalize_text(name).index("salsa"))
+
+
+def test_match_fields_only_adds_unresolved_types_from_later_fields():
+    matcher = build([
+        ("vegan", 1, "diet"),
+        ("keto", 2, "diet"),
+        ("dessert", 3, "course"),
+        ("italian", 4, "cuisine"),
+    ])
+    details = matcher.match_fields(["Vegan Brownies", "a keto dessert, italian style"])
+    # diet was resolved by the name, so keto from the instructions is skipped
+    assert details == {1: (1, 0), 3: (3, None), 4: (4, None)}
+
+
+def test_match_fields_truncates_later_fields_at_words():
+    matcher = build([("ham", 1, "holiday"), ("pie", 2, "course")])
+    details = matcher.match_fields(["Supper", "hamburger with pie"], max_chars=3)
+    assert details == {}
+    details = matcher.match_fields(["Supper", "ham, then pie"], max_chars=4)
+    assert details == {1: (1, None)}